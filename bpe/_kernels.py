@@ -0,0 +1,47 @@
+"""
+Numba-compiled kernels for the hot loops of training.
+These operate in place on flat integer arrays, so no Python object is touched inside the loops.
+"""
+import os
+import sys
+dir_path = os.path.dirname(os.path.realpath(__file__))
+parent_dir_path = os.path.abspath(os.path.join(dir_path, os.pardir))
+sys.path.insert(0, parent_dir_path)
+
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True, boundscheck=False)
+def multi_merge_inplace(ids, p0s, p1s, idxs, packed):
+    """
+    Same as multi_merge() in base.py, for the pairs (p0s[k], p1s[k]) -> idxs[k], but rewrites the array (ids)
+    in place and returns its new length. The write index never overtakes the read index, so no second buffer is needed.
+    No two of the pairs may share a token, so every token starts at most one of them.
+    In the same pass, every consecutive pair of the rewritten ids is written to packed (int64, at least
+    as long as ids) as (left << 32) | right, ready for get_packed_stats(), so that counting the pairs
+    for the next round doesn't need a second pass over ids.
+    """
+    # slot[t] = k if token t starts pair k, else -1
+    size = p0s.max() + 1
+    slot = np.full(size, -1, dtype=np.int64)
+    for k in range(p0s.shape[0]):
+        slot[p0s[k]] = k
+    n = ids.shape[0]
+    i = 0
+    j = 0
+    while i < n:
+        t = ids[i]
+        k = slot[t] if t < size else -1
+        # if not at the very last position, and the pair is one of those to merge, replace it
+        if k >= 0 and i + 1 < n and ids[i+1] == p1s[k]:
+            ids[j] = idxs[k]
+            i += 2
+        else:
+            ids[j] = t
+            i += 1
+        # the pair that ends at the token just written is final
+        if j > 0:
+            packed[j-1] = (np.int64(ids[j-1]) << 32) | np.int64(ids[j])
+        j += 1
+    return j
@@ -6,23 +6,59 @@ import sys
 dir_path = os.path.dirname(os.path.realpath(__file__))
 parent_dir_path = os.path.abspath(os.path.join(dir_path, os.pardir))
 sys.path.insert(0, parent_dir_path)
+import io
 import unicodedata
 
+import numpy as np
+
 #------------------------------------------
 # helper functions for BasicTokenizer and RegexTokenizer
 
-def get_stats(ids, counts=None):
+# the 256 single-byte tokens, built once and shared by every vocab
+_BYTE_TABLE = [bytes([i]) for i in range(256)]
+
+def get_stats(ids, counts=None, weights=None):
     """
     Given a list of integers return a dictionary of tuple counts of consecutive pairs.
     Example: [1, 2, 1, 2, 3] -> {(1, 2): 2, (2, 1): 1, (2, 3): 1 }
     Optionally allows to update an existing dictionary of counts.
+    NumPy integer arrays are counted in one vectorized pass: each pair is packed into a single int64
+    key and np.unique does the counting.
+    For arrays, weights optionally gives how many times the pair starting at each position is counted.
+    Pairs with a weight of 0 are skipped, so many chunks can be laid out back to back in one array
+    and counted with a single call, with a weight of 0 at the last position of each chunk.
     """
     counts = {} if counts is None else counts
+    if isinstance(ids, np.ndarray):
+        packed = (ids[:-1].astype(np.int64) << 32) | ids[1:].astype(np.int64)
+        return get_packed_stats(packed, counts, None if weights is None else weights[:-1])
     for pair in zip(ids, ids[1:]): # iterate pairs
         counts[pair] = counts.get(pair, 0) + 1
     return counts
 
 
+def get_packed_stats(packed, counts=None, weights=None):
+    """
+    Same as get_stats() for an array, but for the pairs given already packed into int64 keys, (p0 << 32) | p1,
+    and weights (optional) for each pair rather than for each position.
+    """
+    counts = {} if counts is None else counts
+    if weights is None:
+        keys, first, freqs = np.unique(packed, return_index=True, return_counts=True)
+    else:
+        counted = weights != 0
+        keys, first, inverse = np.unique(packed[counted], return_index=True, return_inverse=True)
+        freqs = np.bincount(inverse, weights=weights[counted], minlength=len(keys)).astype(np.int64)
+    # np.unique sorts by key; put the pairs back in order of first occurrence, as the
+    # plain loop inserts them, so that max(stats, key=stats.get) breaks ties the same way
+    order = np.argsort(first, kind="stable")
+    keys, freqs = keys[order], freqs[order]
+    # only the unique keys go through the dictionary, far fewer than the elements
+    for key, freq in zip(keys.tolist(), freqs.tolist()):
+        pair = (key >> 32, key & 0xffffffff)
+        counts[pair] = counts.get(pair, 0) + freq
+    return counts
+
 
 def merge(ids, pair, idx):
     """
@@ -43,6 +79,58 @@ def merge(ids, pair, idx):
     return newids
 
 
+def multi_merge(ids, pair_to_idx):
+    """
+    Like merge(), but replaces the consecutive occurences of several pairs (pair_to_idx: pair -> new token idx)
+    in a single pass. Only meaningful when no two of the pairs share a token, see get_merge_batch().
+    Training runs the compiled multi_merge_inplace() in _kernels.py; this is its plain reference.
+    Example: ids=[1, 2, 3, 4, 1, 2], pair_to_idx={(1, 2): 5, (3, 4): 6} -> [5, 6, 5]
+    """
+    newids = []
+    i = 0
+    while i < len(ids):
+        # if not at the very last position, and the pair is one of those to merge, replace it
+        idx = pair_to_idx.get((ids[i], ids[i+1])) if i < len(ids) - 1 else None
+        if idx is not None:
+            newids.append(idx)
+            i += 2
+        else:
+            newids.append(ids[i])
+            i += 1
+
+    return newids
+
+
+def get_merge_batch(stats, max_size):
+    """
+    Given the pair counts of one pass (stats), return the pairs that plain BPE would merge next, in order,
+    so that up to max_size of them can be merged in a single pass (see multi_merge()).
+    The most common pair always qualifies. The next most common pair qualifies too if:
+    - it shares no token with the pairs before it, so merging them leaves its count untouched;
+    - its count is strictly above any count that merging them can create: for a merge (a, b) -> z,
+      the new pair (x, z) occurs at most as often as (x, a), and (z, y) at most as often as (b, y).
+    The batch ends at the first pair that does not qualify, so each pair is exactly the one
+    that max(stats, key=stats.get) would have picked after the merges before it.
+    """
+    # sorted is stable, so ties keep the dictionary order, as in max()
+    ranked = sorted(stats, key=stats.get, reverse=True)
+    # the highest count among the pairs that start / end with each token
+    most_after, most_before = {}, {}
+    for (p0, p1), count in stats.items():
+        most_after[p0] = max(most_after.get(p0, 0), count)
+        most_before[p1] = max(most_before.get(p1, 0), count)
+    batch = []
+    used = set() # tokens of the pairs in the batch
+    bound = 0 # highest possible count of a pair created by the batch
+    for pair in ranked[:max_size]:
+        if batch and (stats[pair] <= bound or pair[0] in used or pair[1] in used):
+            break
+        batch.append(pair)
+        used.update(pair)
+        bound = max(bound, most_before.get(pair[0], 0), most_after.get(pair[1], 0))
+    return batch
+
+
 # two simpler helper functions
 
 def replace_control_characters(s: str) -> str:
@@ -64,6 +152,34 @@ def render_token(t: bytes) -> str:
     return s
 
 
+def read_model(f):
+    """
+    Parse a model file, as written by Tokenizer.save(), from f (an open text file, or any iterable of lines
+    with a readline() method). Returns (pattern, special_tokens, merges).
+    Only the line breaks are stripped: the pattern and the special tokens may begin or end with whitespace.
+    """
+    merges = {}
+    special_tokens = {}
+    idx = 256
+    # read the version
+    version = f.readline().strip()
+    assert version == "bpe v1"
+    # read the pattern
+    pattern = f.readline().rstrip("\n")
+    # read the special tokens
+    num_special = int(f.readline().strip())
+    for _ in range(num_special):
+        # the index comes last, the token itself may contain spaces
+        special, special_idx = f.readline().rstrip("\n").rsplit(" ", 1)
+        special_tokens[special] = int(special_idx)
+    # read the merges
+    for line in f:
+        idx1, idx2 = map(int, line.split())
+        merges[(idx1, idx2)] = idx
+        idx += 1
+    return pattern, special_tokens, merges
+
+
 
 #-------------------------------------------
 # the base Tokenizer class
@@ -78,6 +194,27 @@ class Tokenizer:
         self.special_tokens = {} # str -> int, e.g. {'<|endoftext|>': 100257}
         self.vocab = self._build_vocab() # int -> bytes
 
+    @property
+    def merges(self):
+        # (int, int) -> int, as used by save/load and to build the vocab
+        return self._merges
+
+    @merges.setter
+    def merges(self, merges):
+        self._merges = merges
+        # the packed copy is rebuilt on first use, see _packed_merges()
+        self._merges_packed = None
+
+    def _packed_merges(self):
+        # The encoders look the merges up with each pair packed into one int, (p0 << 32) | p1:
+        # hashing a small int is much cheaper than hashing a tuple of two.
+        # Built on first use after the merges are set. Merges added or removed in place change its size,
+        # which rebuilds it too; changing only the index of an existing merge needs self.merges to be set again
+        packed = self._merges_packed
+        if packed is None or len(packed) != len(self._merges):
+            packed = self._merges_packed = {(p0 << 32) | p1: idx for (p0, p1), idx in self._merges.items()}
+        return packed
+
     def train(self, text, vocab_size, verbose=False):
         # Tokenizer can train a vocabulary of size vocab_size from text
         raise NotImplementedError
@@ -91,8 +228,10 @@ class Tokenizer:
         raise NotImplementedError
 
     def _build_vocab(self):
-        # vocab is simply and deterministically derived from merges
-        vocab = {idx: bytes([idx]) for idx in range(256)}
+        # vocab is simply and deterministically derived from merges.
+        # The merges are in order, so both children of a token already exist when it is built,
+        # and each token costs exactly one allocation: the concatenation of its two children
+        vocab = dict(enumerate(_BYTE_TABLE))
         for (p0, p1), idx in self.merges.items():
             vocab[idx] = vocab[p0] + vocab[p1]
         for special, idx in self.special_tokens.items():
@@ -108,64 +247,53 @@ class Tokenizer:
         # write the model: to be used in load() later
         model_file = file_prefix + ".model"
 
-        with open(model_file, "w") as f:
-            # write the version, pattern and merges
-            f.write("bpe v1\n")
-            f.write(f"{self.pattern}\n")
-            # write the special tokens, first their count, then each one
-            f.write(f"{len(self.special_tokens)}\n")
-            for special, idx in self.special_tokens.items():
-                f.write(f"{special} {idx}\n")
-            # the merges dictionary
-            for idx1, idx2 in self.merges:
-                f.write(f"{idx1} {idx2}\n")
+        # the file is assembled in memory and written in one go, rather than with one write() per line
+        # write the version, pattern and merges
+        lines = ["bpe v1", self.pattern]
+        # write the special tokens, first their count, then each one
+        lines.append(str(len(self.special_tokens)))
+        lines += [f"{special} {idx}" for special, idx in self.special_tokens.items()]
+        # the merges dictionary
+        lines += [f"{idx1} {idx2}" for idx1, idx2 in self.merges]
+        model = "\n".join(lines) + "\n"
+        # make sure that the model reads back as this very model, so that it can stand in for retraining.
+        # It is parsed exactly as load() will (line breaks included), before anything is written
+        if read_model(io.StringIO(model, newline=None)) != (self.pattern, self.special_tokens, self.merges):
+            raise ValueError("the pattern or a special token contains a line break, which the model file cannot hold")
+        with open(model_file, "w", encoding="utf-8") as f:
+            f.write(model)
 
         # write the vocab: for the human to look at
         vocab_file = file_prefix + ".vocab"
         inverted_merges = {idx: pair for pair, idx in self.merges.items()}
+        lines = []
+        for idx, token in self.vocab.items():
+            # Nnote: Many tokens may be partial utf-8 sequences
+            # and cannot be decoded into valid strings.
+            # We will be using errors='replace' to replace them with the replacement char "�".
+            # This also means that we couldn't possibly use
+            # .vocab in load(), because the decoding in this way is a lossy operation
+            s = render_token(token)
+            # find the children of this token, if any
+            if idx in inverted_merges:
+                # if this token has children, render it nicely as a merge
+                idx0, idx1 = inverted_merges[idx]
+                s0 = render_token(self.vocab[idx0])
+                s1 = render_token(self.vocab[idx1])
+                lines.append(f"[{s0}][{s1}] -> [{s}] {idx}")
+            else:
+                # otherwise this is a leaft token, simply print it
+                # (this should just be the first 256 tokens, the bytes)
+                lines.append(f"[{s}] {idx}")
         with open(vocab_file, "w", encoding="utf-8") as f:
-            for idx, token in self.vocab.items():
-                # Nnote: Many tokens may be partial utf-8 sequences
-                # and cannot be decoded into valid strings.
-                # We will be using errors='replace' to replace them with the replacement char "�".
-                # This also means that we couldn't possibly use
-                # .vocab in load(), because the decoding in this way is a lossy operation
-                s = render_token(token)
-                # find the children of this token, if any
-                if idx in inverted_merges:
-                    # if this token has children, render it nicely as a merge
-                    idx0, idx1 = inverted_merges[idx]
-                    s0 = render_token(self.vocab[idx0])
-                    s1 = render_token(self.vocab[idx1])
-                    f.write(f"[{s0}][{s1}] -> [{s}] {idx}\n")
-                else:
-                    # otherwise this is a leaft token, simply print it
-                    # (this should just be the first 256 tokens, the bytes)
-                    f.wirte(f"[{s}] {idx}\n")
+            f.write("\n".join(lines) + "\n")
 
     def load(self, model_file):
         """Inverse or save() but only for the model file"""
         assert model_file.endswith(".model")
         # read the model file
-        merges = {}
-        special_tokens = {}
-        idx = 256
         with open(model_file, 'r', encoding="utf-8") as f:
-            # read the version
-            version = f.readline().strip()
-            assert version == "bpe v1"
-            # read the pattern
-            self.pattern = f.readline().strip()
-            # read the special tokens
-            num_special = int(f.readline().strip())
-            for _ in range(num_special):
-                special, special_idx = f.readline().strip().split()
-                special_token[special] = int(special_idx)
-            # read the merges
-            for line in f:
-                idx1, idx2 = map(int, line.split())
-                merges[(idx1, idx2)] = idx
-                idx += 1
+            self.pattern, special_tokens, merges = read_model(f)
         self.merges = merges
         self.special_tokens = special_tokens
         self.vocab = self._build_vocab()
@@ -14,7 +14,9 @@ dir_path = os.path.dirname(os.path.realpath(__file__))
 parent_dir_path = os.path.abspath(os.path.join(dir_path, os.pardir))
 sys.path.insert(0, parent_dir_path)
 
-from .base import Tokenizer, get_stats, merge
+import numpy as np
+from .base import Tokenizer, get_stats, get_packed_stats, merge, get_merge_batch, _BYTE_TABLE
+from ._kernels import multi_merge_inplace
 
 class BasicTokenizer(Tokenizer):
 
@@ -27,26 +29,41 @@ class BasicTokenizer(Tokenizer):
 
         # input text preprocessing
         text_bytes = text.encode("utf-8") # raw bytes
-        ids = list(text_bytes) # list of integers in range 0-255
+        # integers in range 0-255, as uint16 if all token ids fit (half the memory traffic of int32)
+        ids = np.frombuffer(text_bytes, dtype=np.uint8).astype(np.uint16 if vocab_size <= 65536 else np.int32)
 
         # iteratively merge the most common pairs to create new tokens
         merges = {} # (int, int) -> int
-        vocab = {idx: bytes([idx]) for idx in range(256)} # int -> bytes
-        for i in range(num_merges):
-            # count up the number of times every consecutive pair appears
-            stats = get_stats(ids)
-            # find the pair with the highest count
-            pair = max(stats, key=stats.get)
-            # mint a new token: assign it the next available id
-            idx = 256 + i
-            # replace all occurences of pair in ids with idx
-            ids = merge(ids, pair, idx)
-            # save the merge
-            merges[pair] = idx
-            vocab[idx] = vocab[pair[0]] + vocab[pair[1]]
-            # prints
-            if verbose:
-                print(f"merge {i+1}/{num_merges}: {pair} -> {idx} ({vocab[idx]}) had {stats[pair]} occurences")
+        vocab = dict(enumerate(_BYTE_TABLE)) # int -> bytes
+        # count up the number of times every consecutive pair appears.
+        # After this first pass, the pairs come out of the merge pass itself (see multi_merge_inplace)
+        stats = get_stats(ids)
+        packed = np.empty(len(ids), dtype=np.int64)
+        i = 0
+        while i < num_merges:
+            # find the pair with the highest count, along with the pairs that would come right after it
+            # and can safely be merged in the same pass (see get_merge_batch)
+            batch = get_merge_batch(stats, num_merges - i)
+            if not batch:
+                raise ValueError(f"no more pairs to merge after {i} merges, vocab_size={vocab_size} is too large for this text")
+            # mint new tokens: assign them the next available ids
+            idxs = np.arange(256 + i, 256 + i + len(batch), dtype=ids.dtype)
+            # replace all occurences of the pairs in ids with their new ids
+            p0s = np.array([pair[0] for pair in batch], dtype=ids.dtype)
+            p1s = np.array([pair[1] for pair in batch], dtype=ids.dtype)
+            ids = ids[:multi_merge_inplace(ids, p0s, p1s, idxs, packed)]
+            for pair in batch:
+                idx = 256 + i
+                # save the merge
+                merges[pair] = idx
+                vocab[idx] = vocab[pair[0]] + vocab[pair[1]]
+                # prints
+                if verbose:
+                    print(f"merge {i+1}/{num_merges}: {pair} -> {idx} ({vocab[idx]}) had {stats[pair]} occurences")
+                i += 1
+            # count the pairs of the merged ids, as written out by the merge pass
+            if i < num_merges:
+                stats = get_packed_stats(packed[:len(ids) - 1])
 
         # save class variables
         self.merges = merges # used in encode()
@@ -62,17 +79,18 @@ class BasicTokenizer(Tokenizer):
         # given a string text, return the token ids
         text_bytes = text.encode("utf-8") # raw bytes
         ids = list(text_bytes) # list of integers in range 0-255
+        merges = self.merges
         while len(ids) >= 2:
             # find the pair with the lowest merge index
             stats = get_stats(ids)
-            pair = min(stats, key=lambda p: self.merges.get(p, float("inf")))
+            pair = min(stats, key=lambda p: merges.get(p, float("inf")))
             # Subtle: If there are no more merges available, the key will result in an inf for every single pair,
             # and the min will be just the first pair in the list,
             # arbitrarily.
             # We can detect this terminating case by a membership check.
-            if pair not in self.merges:
+            if pair not in merges:
                 break # nothing else can be merged anymore
             # otherwise merge the best pair (lowest merge index)
-            idx = self.merges[pair]
+            idx = merges[pair]
             ids = merge(ids, pair, idx)
         return ids
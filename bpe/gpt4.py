@@ -10,11 +10,12 @@ parent_dir_path = os.path.abspath(os.path.join(dir_path, os.pardir))
 sys.path.insert(0, parent_dir_path)
 
 import tiktoken
+from .base import _BYTE_TABLE
 from .regex import RegexTokenizer
 
 def bpe(mergeable_ranks, token, max_rank):
     # Helper function used in get_gpt4_merges() to reconstruct the merge forest
-    parts = [bytes([b]) for b in token]
+    parts = [_BYTE_TABLE[b] for b in token]
     while True:
         min_idx = None
         min_rank = None
@@ -65,20 +66,17 @@ class GPT4Tokenizer(RegexTokenizer):
         # the merges are those of gpt4, but we have to recover them
         self.merges = recover_merges(mergeable_ranks)
         # reconstruct the vocab from the merges
-        vocab = {idx: bytes([idx]) for idx in range(256)}
-        for (p0, p1), idx in self.merges.items():
-            vocab[idx] = vocab[p0] + vocab[p1]
-        self.vocab = vocab
+        self.vocab = self._build_vocab()
         # For some reason, the tokens corresponding to individual bytes are permuted in a different order. We have to deal with it here:
-        self.byte_shuffle = {i: mergeable_ranks[bytes([i])] for i in range(256)}
+        self.byte_shuffle = {i: mergeable_ranks[_BYTE_TABLE[i]] for i in range(256)}
         self.inverse_byte_shuffle = {v: k for k, v in self.byte_shuffle.items()}
         # finally register the special tokens
         self.register_special_tokens(GPT4_SPECIAL_TOKENS)
 
-    def _encode_chunk(self, text_bytes):
+    def _encode_chunk_uncached(self, text_bytes):
         # Before starting to process bytes, we have to permute them
         text_bytes = bytes(self.byte_shuffle[b] for b in text_bytes)
-        ids = super()._encode_chunk(text_bytes)
+        ids = super()._encode_chunk_uncached(text_bytes)
         return ids
 
     def decode(self, ids):
@@ -107,18 +105,20 @@ class GPT4Tokenizer(RegexTokenizer):
         # python -c "from bpe import GPT-4Tokenizer; GPT4Tokenizer().save_vocab('gpt4.vocab')"
         from .base import render_token
         # build vocab being mindful of the byte shuffle
-        vocab = {idx: bytes([self.inverse_byte_shuffle[idx]]) for idx in range(256)}
-        for (p01, p1), idx in self.merges.items():
+        vocab = {idx: _BYTE_TABLE[self.inverse_byte_shuffle[idx]] for idx in range(256)}
+        for (p0, p1), idx in self.merges.items():
             vocab[idx] = vocab[p0] + vocab[p1]
         # Now merge the shuffled bytes and write to file
         inverted_merges = {idx: pair for pair, idx in self.merges.items()}
+        lines = []
+        for idx, token in vocab.items():
+            s = render_token(token)
+            if idx in inverted_merges:
+                idx0, idx1 = inverted_merges[idx]
+                s0 = render_token(vocab[idx0])
+                s1 = render_token(vocab[idx1])
+                lines.append(f"[{s0}][{s1}] -> [{s}] {idx}")
+            else:
+                lines.append(f"[{s}] {idx}")
         with open(vocab_file, "w", encoding="utf-8") as f:
-            for idx, token in vocab.items():
-                s = render_token(token)
-                if idx in inverted_merges:
-                    idx0, idx1 = inverted_merges[idx]
-                    s0 = render_token(vocab[idx0])
-                    s1 = render_token(vocab[idx1])
-                    f.write(f"[{s0}][{s1}] -> [{s}] {idx}\n")
-                else:
-                    f.write(f"[{s}] {idx}\n")
+            f.write("\n".join(lines) + "\n")
@@ -15,13 +15,69 @@ dir_path = os.path.dirname(os.path.realpath(__file__))
 parent_dir_path = os.path.abspath(os.path.join(dir_path, os.pardir))
 sys.path.insert(0, parent_dir_path)
 
+import functools
+import heapq
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import ahocorasick
+import numpy as np
 import regex as re
-from .base import Tokenizer, get_stats, merge
+from .base import Tokenizer, get_stats, _BYTE_TABLE
 
 # the main GPT text split patterns, see:
 # https://github.com/openai/tiktoken/blob/main/tiktoken_ext/openai_public.py
 GPT2_SPLIT_PATTERN = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
-GPT4_SPLIT_PATTERN = r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]++[\r\n]*|\s*[\r\n]|\s+(?1\S)|\s+ """
+GPT4_SPLIT_PATTERN = r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]++[\r\n]*|\s*[\r\n]|\s+(?!\S)|\s+"""
+
+
+@functools.lru_cache(maxsize=32)
+def _compile(pattern):
+    # compiled patterns are shared by all tokenizers in the process, instead of being rebuilt per instance
+    return re.compile(pattern)
+
+
+@functools.lru_cache(maxsize=32)
+def _special_automaton(special):
+    # special (a frozenset of special tokens) -> Aho-Corasick automaton that finds all of them
+    # in a single pass over the text, however many there are
+    automaton = ahocorasick.Automaton()
+    for token in special:
+        automaton.add_word(token, token)
+    automaton.make_automaton()
+    return automaton
+
+
+# a lone newline between two non-whitespace characters. None of the chunks of the GPT-2/GPT-4 split patterns
+# can straddle such a newline, and it always becomes a chunk "\n" of its own, so text that is cut right
+# after it splits into exactly the same chunks as the whole text does. This does not hold for patterns in
+# general (e.g. r"[^ ]+| +" keeps the newline inside a chunk), so only those two are ever sharded
+SHARD_BOUNDARY_PATTERN = r"(?<=\S)\n(?=\S)"
+
+# number of distinct chunks whose encodings a tokenizer keeps memoized, see RegexTokenizer.encode_ordinary()
+ENCODE_CACHE_SIZE = 65536
+
+
+def _shard_text(text, num_shards):
+    # cut text into (at most) num_shards pieces of roughly equal length, at SHARD_BOUNDARY_PATTERN matches only
+    boundary = _compile(SHARD_BOUNDARY_PATTERN)
+    cuts = [0]
+    for k in range(1, num_shards):
+        m = boundary.search(text, max(cuts[-1], len(text) * k // num_shards))
+        if m is None:
+            break
+        cuts.append(m.end())
+    cuts.append(len(text))
+    return [text[start:end] for start, end in zip(cuts, cuts[1:]) if start < end]
+
+
+def _count_chunks(pattern, text):
+    # split text with the pattern and count how often each distinct chunk (as utf-8 bytes) occurs.
+    # The chunks are streamed through finditer and only the distinct ones are kept, so the list of
+    # all chunks is never materialized, and only the distinct chunks are encoded to utf-8.
+    # Module-level so that it can be shipped to worker processes
+    chunk_freqs = Counter(m.group() for m in _compile(pattern).finditer(text))
+    return Counter({chunk.encode("utf-8"): freq for chunk, freq in chunk_freqs.items()})
 
 
 class RegexTokenizer(Tokenizer):
@@ -34,51 +90,173 @@ class RegexTokenizer(Tokenizer):
         """
         super().__init__()
         self.pattern = GPT4_SPLIT_PATTERN if pattern is None else pattern
-        self.compiled_pattern = re.compile(self.pattern)
+        self.compiled_pattern = _compile(self.pattern)
         self.special_tokens = {}
         self.inverse_special_tokens = {}
+        self._special_detect = None # finds any special token in text, see register_special_tokens()
+        # natural text repeats the same chunks over and over, so their encodings are memoized:
+        # chunk (str) -> token ids (tuple), keyed on the chunk text itself so that a cache hit skips
+        # even the utf-8 encoding. A plain dict owned by this instance, so that copies and pickles
+        # don't share it. It is emptied when it fills up (see encode_ordinary()), and replaced
+        # whenever the merges change (see _packed_merges())
+        self._encode_cache = {}
 
-    def train(self, text, vocab_size, verbose=False):
+    def __getstate__(self):
+        # the cache is derived from the merges, there is no need to copy or pickle it
+        state = self.__dict__.copy()
+        state["_encode_cache"] = {}
+        return state
+
+    def _packed_merges(self):
+        packed = self._merges_packed
+        rebuilt = super()._packed_merges()
+        # a rebuild means the merges changed, so the encodings cached from the old ones are stale
+        if rebuilt is not packed:
+            self._encode_cache = {}
+        return rebuilt
+
+    def train(self, text, vocab_size, verbose=False, num_procs=1):
+        """
+        - num_procs: number of worker processes that split and count the text. This is the only pass over
+          the whole corpus, the merges themselves only touch the distinct chunks. The text is cut into
+          shards at lone newlines (see SHARD_BOUNDARY_PATTERN), which is exact for the GPT-2/GPT-4 patterns only:
+          with any other pattern a chunk could straddle the cut, so the text is counted in this process instead
+        """
         assert vocab_size >= 256
         num_merges = vocab_size - 256
 
-        # split the text up into text chunks
-        text_chunks = re.findall(self.compiled_pattern, text)
+        # split the text up into text chunks, and count how often each distinct chunk occurs.
+        # Natural text repeats the same chunks (" the", "\n", ...) over and over, so every chunk
+        # is stored and scanned only once, and its pairs are weighted by the chunk's count instead
+        if num_procs > 1 and self.pattern in (GPT2_SPLIT_PATTERN, GPT4_SPLIT_PATTERN):
+            shards = _shard_text(text, num_procs)
+            chunk_freqs = Counter()
+            with ProcessPoolExecutor(max_workers=len(shards)) as executor:
+                for shard_freqs in executor.map(_count_chunks, [self.pattern] * len(shards), shards):
+                    chunk_freqs += shard_freqs
+        else:
+            chunk_freqs = _count_chunks(self.pattern, text)
+        # only the distinct chunks are needed from here on
+        del text
+
+        # input text preprocessing: the distinct chunks are laid out back to back in a single array.
+        # Token ids fit in uint16 for vocabularies of up to 65536 tokens, which halves the memory
+        # (and memory traffic) of int32; only larger vocabularies need the wider type
+        ids = np.frombuffer(b"".join(chunk_freqs), dtype=np.uint8).astype(np.uint16 if vocab_size <= 65536 else np.int32)
+        lengths = np.fromiter(map(len, chunk_freqs), dtype=np.int64, count=len(chunk_freqs))
+        freqs = np.fromiter(chunk_freqs.values(), dtype=np.int64, count=len(chunk_freqs))
+        # every position starts a pair, except the last position of each chunk
+        n = len(ids)
+        starts_pair = np.ones(n, dtype=bool)
+        starts_pair[np.cumsum(lengths) - 1] = False
+        sites = np.flatnonzero(starts_pair)
 
-        # input text preprocessing
-        ids = [list(ch.encode("utf-8")) for ch in text_chunks]
+        # count the number of times every consecutive pair appears (vectorized over all chunks),
+        # where each position is weighted by the count of the chunk it belongs to, and a weight of 0
+        # at the end of every chunk makes sure that no pair is ever counted across two chunks.
+        # This is the only full pass: from here on the counts are updated incrementally, because
+        # merging a pair only changes the pairs right around the sites where it occurs
+        weights = np.repeat(freqs, lengths)
+        stats = get_stats(ids, weights=np.where(starts_pair, weights, 0))
+
+        # every chunk is a doubly-linked list over its slots in ids: nxt/prv hold the position of the
+        # next/previous token of the same chunk, or -1 at the chunk boundaries. Merging a pair at
+        # position p then rewrites ids[p] and unlinks its right neighbour in O(1), without moving anything
+        nxt = np.full(n, -1, dtype=np.int32)
+        prv = np.full(n, -1, dtype=np.int32)
+        nxt[sites] = sites + 1
+        prv[sites + 1] = sites
+        # memoryviews give plain Python ints on indexing, which is much faster than going through numpy scalars
+        ids_v, nxt_v, prv_v, weights_v = memoryview(ids), memoryview(nxt), memoryview(prv), memoryview(weights)
+        # inverted index pair -> {position}, to locate the sites of a pair without scanning the corpus
+        where = defaultdict(set)
+        for p in sites.tolist():
+            where[(ids_v[p], ids_v[p + 1])].add(p)
+        # max-heap of (-count, first site, pair). Among equal counts the pair whose first site comes first
+        # wins, which is the pair that occurs first in the text: the order max() sees the pairs in when
+        # counting from scratch. Entries go stale when a count drops or a first site goes away, and are
+        # refreshed when popped. Only the new pairs ever gain sites, and those are pushed afresh
+        heap = [(-count, min(where[pair]), pair) for pair, count in stats.items()]
+        heapq.heapify(heap)
 
         # iteratively merge the most common pairs to create new tokens
         merges = {} # (int, int) -> int
-        vocab = {idx: bytes([idx]) for idx in range(256)} # idx -> bytes
+        vocab = dict(enumerate(_BYTE_TABLE)) # idx -> bytes
         for i in range(num_merges):
-            # count the number of times every consecutive pair appears
-            stats = {}
-            for chunk_ids in ids:
-                # passing in stats will update it in place, adding up counts
-                get_stats(chunk_ids, stats)
-            # find the pair with the highest count
-            pair = max(stats, key=stats.get)
+            # find the pair with the highest count (ties go to the pair that occurs first)
+            while True:
+                if not heap:
+                    raise ValueError(f"no more pairs to merge after {i} merges, vocab_size={vocab_size} is too large for this text")
+                neg_count, first, pair = heapq.heappop(heap)
+                count = stats.get(pair, 0)
+                if count <= 0:
+                    continue
+                site = min(where[pair])
+                if count == -neg_count and site == first:
+                    break
+                heapq.heappush(heap, (-count, site, pair))
             # mint a new token: assign it the next available id
             idx = 256 + i
-            # replace all occurences of pair in ids with idx
-            ids = [merge(chunk_ids, pair, idx) for chunk_ids in ids]
+            # replace all occurences of pair with idx, left to right within each chunk. Each site moves
+            # the weight of its neighbouring pairs (x, a), (b, y) over to (x, idx), (idx, y)
+            a, b = pair
+            increased = set()
+            for p in sorted(where.pop(pair)):
+                q = nxt_v[p]
+                # skip sites that an earlier overlapping merge already consumed (e.g. the second pair in "aaa")
+                if q < 0 or ids_v[p] != a or ids_v[q] != b:
+                    continue
+                freq = weights_v[p]
+                x = prv_v[p]
+                y = nxt_v[q]
+                if x >= 0:
+                    old_pair, new_pair = (ids_v[x], a), (ids_v[x], idx)
+                    stats[old_pair] -= freq
+                    stats[new_pair] = stats.get(new_pair, 0) + freq
+                    where[old_pair].discard(x)
+                    where[new_pair].add(x)
+                    increased.add(new_pair)
+                if y >= 0:
+                    old_pair, new_pair = (b, ids_v[y]), (idx, ids_v[y])
+                    stats[old_pair] -= freq
+                    stats[new_pair] = stats.get(new_pair, 0) + freq
+                    where[old_pair].discard(q)
+                    where[new_pair].add(p)
+                    increased.add(new_pair)
+                    prv_v[y] = p
+                stats[pair] -= freq
+                # splice: p now holds the merged token, q drops out of the list
+                ids_v[p] = idx
+                nxt_v[p] = y
+                nxt_v[q] = prv_v[q] = -1
+            for p in increased:
+                if stats[p] > 0:
+                    heapq.heappush(heap, (-stats[p], min(where[p]), p))
+            del stats[pair]
             # save the merge
             merges[pair] = idx
             vocab[idx] = vocab[pair[0]] + vocab[pair[1]]
             # prints
             if verbose:
-                print(f"merge {i+1}/{num_merges}: {pair} -> {idx} ({vocab[idx]}) had {stats[pair]} occurences")
+                print(f"merge {i+1}/{num_merges}: {pair} -> {idx} ({vocab[idx]}) had {count} occurences")
 
         # save class variables
         self.merges = merges # used in encode()
         self.vocab = vocab   # used in decode()
 
+    def load(self, model_file):
+        super().load(model_file)
+        # the model file brings its own pattern and special tokens
+        self.compiled_pattern = _compile(self.pattern)
+        self.register_special_tokens(self.special_tokens)
+
     def register_special_tokens(self, special_tokens):
         # Special_tokens is a dictionary of str -> int.
         # Example: {"<|endoftext|>": 100257}
         self.special_tokens = special_tokens
         self.inverse_special_tokens = {v: k for k, v in special_tokens.items()}
+        # built here once, so that encode() checks text against all special tokens in a single pass
+        self._special_detect = _special_automaton(frozenset(special_tokens)) if special_tokens else None
 
     def decode(self, ids):
         # Given ids (list of integers), return Python string
@@ -87,41 +265,90 @@ class RegexTokenizer(Tokenizer):
             if idx in self.vocab:
                 part_bytes.append(self.vocab[idx])
             elif idx in self.inverse_special_tokens:
-                party_bytes.append(self.inverse_special_tokens[idx].encode("utf-8"))
+                part_bytes.append(self.inverse_special_tokens[idx].encode("utf-8"))
             else:
                 raise ValueError(f"invalid token id: {idx}")
         text_bytes = b"".join(part_bytes)
         text = text_bytes.decode("utf-8", errors="replace")
         return text
 
-    def _encode_chunk(self, text_bytes):
-        # return the token ids
+    def _encode_chunk_uncached(self, text_bytes):
+        # return the token ids as a tuple, so that the result can be cached (see _encode_cache).
+        # They stay Python ints, unlike the uint16 ids of training: every chunk is a handful of tokens that
+        # end up extended into the caller's list of ints, so an array would only add a conversion per chunk
         # first, convert all bytes to integers in range 0-255:
         ids = list(text_bytes)
-        while len(ids) >= 2:
-            # find the pair with the lowest merge index
-            stats = get_stats(ids)
-            pair = min(stats, key=lambda p: self.merges.get(p, float("inf")))
-            # Subtle: If there are no more merges available, the key will result in an inf for every single pair, and
-            # the min will be just the first pair in the list,
-            # arbitrarily.
-            # We can detect this terminating case by a membership check
-            if pair not in self.merges:
-                break # nothing else can be merged anymore
-            # otherwise let's merge the best pair (lowest merge index)
-            idx = self.merges[pair]
-            ids = merge(ids, pair, idx)
-        return ids
+        # Repeatedly merging the pair with the lowest merge index, rescanning the chunk each time, is O(L^2).
+        # Instead, every candidate pair sits in a min-heap keyed on (merge index, position), so the lowest
+        # merge index comes out first and its occurences come out left to right, which gives the same result.
+        # The tokens form a linked list through nxt/prv, so a merge is an O(1) splice.
+        # Entries are never removed from the heap; they are checked when popped and skipped if stale.
+        # Pairs are looked up packed into a single int, which hashes faster than a tuple (see Tokenizer._packed_merges)
+        merges = self._packed_merges()
+        n = len(ids)
+        if n < 2:
+            return tuple(ids)
+        nxt = list(range(1, n)) + [-1]
+        prv = list(range(-1, n - 1))
+        heap = []
+        for i in range(n - 1):
+            idx = merges.get((ids[i] << 32) | ids[i+1])
+            if idx is not None:
+                heap.append((idx, i))
+        heapq.heapify(heap)
+        while heap:
+            idx, left = heapq.heappop(heap)
+            right = nxt[left]
+            # the left token was merged away, or the pair starting at it has changed since the push
+            if right < 0 or merges.get((ids[left] << 32) | ids[right]) != idx:
+                continue
+            # merge: the left slot takes the new token, the right slot drops out of the list
+            ids[left] = idx
+            after = nxt[right]
+            nxt[left] = after
+            if after >= 0:
+                prv[after] = left
+            nxt[right] = -1
+            # the two neighbouring pairs are new candidates
+            before = prv[left]
+            if before >= 0:
+                new_idx = merges.get((ids[before] << 32) | idx)
+                if new_idx is not None:
+                    heapq.heappush(heap, (new_idx, before))
+            if after >= 0:
+                new_idx = merges.get((idx << 32) | ids[after])
+                if new_idx is not None:
+                    heapq.heappush(heap, (new_idx, left))
+        # walk the list from its head (the first token is never merged away)
+        out = []
+        i = 0
+        while i >= 0:
+            out.append(ids[i])
+            i = nxt[i]
+        return tuple(out)
+
+    def _encode_piece(self, chunk):
+        # encode one chunk of text (str), see _encode_cache
+        return self._encode_chunk_uncached(chunk.encode("utf-8"))
 
     def encode_ordinary(self, text):
         """Encoding that ignores any special tokens."""
-        # Split text into chunks of text by categories defined in regex pattern
-        text_chunks = re.findall(self.compiled_pattern, text)
+        # Split text into chunks of text by categories defined in regex pattern.
+        # finditer yields them one at a time, so the list of all chunks is never materialized
         # All chunks of text are encoded separately, then results are joined
         ids = []
-        for chunk in text_chunks:
-            chunk_bytes = chunk.encode("utf-8") # raw bytes
-            chunk_ids = self._encode_chunk(chunk_bytes)
+        # check the packed merges first: rebuilding them also drops the encodings cached from the old ones
+        self._packed_merges()
+        cache = self._encode_cache
+        for match in self.compiled_pattern.finditer(text):
+            chunk = match.group()
+            chunk_ids = cache.get(chunk)
+            if chunk_ids is None:
+                chunk_ids = self._encode_piece(chunk)
+                # start over once full: cheaper than tracking recency, and the frequent chunks come right back
+                if len(cache) >= ENCODE_CACHE_SIZE:
+                    cache.clear()
+                cache[chunk] = chunk_ids
             ids.extend(chunk_ids)
         return ids
 
@@ -141,7 +368,10 @@ class RegexTokenizer(Tokenizer):
             special = {}
         elif allowed_special == "none_raise":
             special = {}
-            assert all(token not in text for token in self.special_tokens)
+            # stops at the first special token found
+            match = next(self._special_detect.iter(text), None) if self._special_detect is not None else None
+            if match is not None:
+                raise ValueError(f"encountered text corresponding to disallowed special token {match[1]!r}")
         elif isinstance(allowed_special, set):
             special = {k: v for k, v in self.special_tokens.items() if k in allowed_special}
         else:
@@ -152,18 +382,21 @@ class RegexTokenizer(Tokenizer):
         # Otherwise, we have to be careful with potential special tokens in text.
         # We handle special tokens by splititng the text based on
         # the occurence of any exact match with any of the special tokens.
-        # We can use re.split for this. Note that surrounding the pattern with () makes it into a capturing group,
-        # so the special tokens will be included.
-        special_pattern = "(" + "|".join(re.escape(k) for k in special) + ")"
-        special_chunks = re.split(special_pattern, text)
-        # Now all the special characters are separated from the rest of the text.
-        # All chunks of text are encoded separately, the results are joined.
+        # The automaton finds every occurrence of every special token in one pass, as (end index, token).
+        # Ordered by start, longest first, the leftmost-longest non-overlapping ones are kept.
+        # (The automaton's own iter_long() can't be used here: it drops a match when the text ends
+        # partway into a longer special token, e.g. "text" at the end of "<|endoftext".)
+        # The text between two matches is an ordinary sequence, encoded normally,
+        # and each match is a special token, encoded separately as a special case.
+        matches = sorted((end + 1 - len(token), -len(token), token)
+                         for end, token in _special_automaton(frozenset(special)).iter(text))
         ids = []
-        for part in special_chunks:
-            if part in special:
-                # this is a special token, encode it separately as a special case
-                ids.append(special[part])
-            else:
-                # this is an ordinary sequence, encode it normally
-                ids.extend(self.encode_ordinary(part))
+        start = 0
+        for match_start, _, token in matches:
+            if match_start < start:
+                continue # overlaps the match before
+            ids.extend(self.encode_ordinary(text[start:match_start]))
+            ids.append(special[token])
+            start = match_start + len(token)
+        ids.extend(self.encode_ordinary(text[start:]))
         return ids
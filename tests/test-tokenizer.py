@@ -78,7 +78,7 @@ def test_gpt4_tiktoken_equality_special_tokens():
     tokenizer = GPT4Tokenizer()
     enc = tiktoken.get_encoding("cl100k_base")
     tiktoken_ids = enc.encode(specials_string, allowed_special="all")
-    gpt4_tokenizer_ids = tokenizer.encode(special_string, allowed_special="all")
+    gpt4_tokenizer_ids = tokenizer.encode(specials_string, allowed_special="all")
     assert gpt4_tokenizer_ids == tiktoken_ids
 
 # Reference test to add more tests in the future
@@ -111,6 +111,64 @@ def test_wikipedia_example(tokenizer_factory):
     assert ids == [258, 100, 258, 97, 99]
     assert tokenizer.decode(tokenizer.encode(text)) == text
 
+def reference_merges(chunks, num_merges):
+    # The plain algorithm: recount every pair over all chunks, merge the most frequent one, repeat.
+    # Ties go to the pair that occurs first, as max() returns the first maximal key of the dict.
+    from bpe.base import get_stats, merge
+    ids = [list(chunk.encode("utf-8")) for chunk in chunks]
+    merges = {}
+    for i in range(num_merges):
+        stats = {}
+        for chunk_ids in ids:
+            get_stats(chunk_ids, stats)
+        if not stats:
+            break
+        pair = max(stats, key=stats.get)
+        ids = [merge(chunk_ids, pair, 256 + i) for chunk_ids in ids]
+        merges[pair] = 256 + i
+    return merges
+
+def test_basic_train_matches_reference():
+    # The vectorized, batched training (see get_merge_batch) must pick the same merges, ties included
+    text = unpack("FILE:taylorswift.txt")[:20000]
+    tokenizer = BasicTokenizer()
+    tokenizer.train(text, 256 + 64)
+    assert tokenizer.merges == reference_merges([text], 64)
+
+@pytest.mark.parametrize("tokenizer_factory", [BasicTokenizer, RegexTokenizer])
+@pytest.mark.parametrize("text", ["", "ab", "aaaa"])
+def test_train_out_of_pairs(tokenizer_factory, text):
+    # Asking for more merges than the text has pairs for is a clear error
+    with pytest.raises(ValueError, match="no more pairs to merge"):
+        tokenizer_factory().train(text, 256 + 44)
+
+def test_multi_merge_inplace():
+    # The compiled merge pass must agree with multi_merge(), and write out the pairs of its result
+    import random
+    import numpy as np
+    from bpe.base import multi_merge
+    from bpe._kernels import multi_merge_inplace
+    random.seed(0)
+    pair_to_idx = {(0, 1): 20, (2, 3): 21, (4, 4): 22, (6, 5): 23} # no two pairs share a token
+    for _ in range(100):
+        ids = [random.randrange(8) for _ in range(random.randrange(50))]
+        expected = multi_merge(ids, pair_to_idx)
+        arr = np.array(ids, dtype=np.uint16)
+        packed = np.empty(len(ids), dtype=np.int64)
+        p0s, p1s = (np.array(p, dtype=np.uint16) for p in zip(*pair_to_idx))
+        idxs = np.array(list(pair_to_idx.values()), dtype=np.uint16)
+        n = multi_merge_inplace(arr, p0s, p1s, idxs, packed)
+        assert arr[:n].tolist() == expected
+        assert packed[:n-1].tolist() == [(a << 32) | b for a, b in zip(expected, expected[1:])]
+
+def test_regex_train_matches_reference():
+    # The incremental training must pick the same merges, ties included
+    import regex as re
+    text = unpack("FILE:taylorswift.txt")[:50000]
+    tokenizer = RegexTokenizer()
+    tokenizer.train(text, 256 + 64)
+    assert tokenizer.merges == reference_merges(re.findall(tokenizer.pattern, text), 64)
+
 @pytest.mark.parametrize("special_tokens", [{}, special_tokens])
 def test_save_load(special_tokens):
     # Take a slightly more complex piece of text and train the tokenizer, chosen at random
@@ -136,5 +194,90 @@ def test_save_load(special_tokens):
     for file in ["test_tokenizer_tmp.model", "test_tokenizer_tmp.vocab"]:
         os.remove(file)
 
+@pytest.mark.parametrize("pattern", [None, r"[^ ]+| +"])
+def test_train_num_procs(pattern):
+    # Counting the chunks in several processes must give exactly the same merges, for any pattern
+    text = specials_string
+    tokenizer = RegexTokenizer(pattern=pattern)
+    tokenizer.train(text, 256 + 32)
+    sharded = RegexTokenizer(pattern=pattern)
+    sharded.train(text, 256 + 32, num_procs=2)
+    assert sharded.merges == tokenizer.merges
+
+def test_pickle_and_deepcopy():
+    # Copies must encode like the original, and retraining a copy must not affect the original
+    import copy
+    import pickle
+    text = llama_text
+    tokenizer = RegexTokenizer()
+    tokenizer.train(text, 256 + 64)
+    tokenizer.register_special_tokens(special_tokens)
+    ids = tokenizer.encode(text, "all")
+    assert pickle.loads(pickle.dumps(tokenizer)).encode(text, "all") == ids
+    assert pickle.loads(pickle.dumps(tokenizer.merges)) == copy.deepcopy(tokenizer.merges) == tokenizer.merges
+    clone = copy.deepcopy(tokenizer)
+    assert clone.encode(text, "all") == ids
+    clone.train("aaabdaaabac", 256 + 3)
+    assert clone.encode("aaabdaaabac") == [258, 100, 258, 97, 99]
+    assert tokenizer.encode(text, "all") == ids
+
+def test_set_merges():
+    # Merges added in place or assigned anew take effect, even for chunks whose encoding is cached
+    tokenizer = RegexTokenizer()
+    assert tokenizer.encode("hi hi") == [104, 105, 32, 104, 105]
+    tokenizer.merges[(104, 105)] = 256
+    assert tokenizer.encode("hi hi") == [256, 32, 256]
+    tokenizer.merges = {(32, 104): 256}
+    assert tokenizer.encode("hi hi") == [104, 105, 256, 105]
+
+def test_disallowed_special_tokens():
+    # By default ("none_raise"), special tokens in the text are an error; with "none" they are ordinary text
+    tokenizer = RegexTokenizer()
+    tokenizer.register_special_tokens(special_tokens)
+    with pytest.raises(ValueError):
+        tokenizer.encode(specials_string)
+    assert tokenizer.encode(specials_string, "none") == tokenizer.encode_ordinary(specials_string)
+    assert tokenizer.encode("no special tokens here") == tokenizer.encode_ordinary("no special tokens here")
+
+def test_nested_special_tokens():
+    # A special token inside another one is found even where the text cuts the longer one short,
+    # and a complete longer token wins over the shorter one inside it
+    tokenizer = RegexTokenizer()
+    tokenizer.register_special_tokens({"<|endoftext|>": 300, "text": 301})
+    assert tokenizer.encode("<|endoftext", "all") == tokenizer.encode_ordinary("<|endof") + [301]
+    assert tokenizer.encode("a<|endoftext|>text", "all") == [97, 300, 301]
+    tokenizer.register_special_tokens({"<|a|>": 300, "a": 301})
+    assert tokenizer.encode("<|a", "all") == [60, 124, 301]
+    assert tokenizer.encode("<|a|>a", "all") == [300, 301]
+    with pytest.raises(ValueError):
+        tokenizer.encode("<|a")
+
+@pytest.mark.parametrize("pattern", ["GPT2", r" ?\w+| ?[^\w\s]+|\s+"])
+def test_save_load_pattern(pattern):
+    # The pattern is part of the model: a loaded tokenizer must split text exactly like the saved one,
+    # even if the pattern begins or ends with whitespace
+    from bpe.regex import GPT2_SPLIT_PATTERN
+    pattern = GPT2_SPLIT_PATTERN if pattern == "GPT2" else pattern
+    text = llama_text
+    tokenizer = RegexTokenizer(pattern=pattern)
+    tokenizer.train(text, 256 + 64)
+    tokenizer.register_special_tokens({" <|end of text|>": 100257})
+    ids = tokenizer.encode(text, "all")
+    tokenizer.save("test_tokenizer_tmp")
+    tokenizer = RegexTokenizer()
+    tokenizer.load("test_tokenizer_tmp.model")
+    assert tokenizer.pattern == pattern
+    assert tokenizer.special_tokens == {" <|end of text|>": 100257}
+    assert tokenizer.encode(text, "all") == ids
+    for file in ["test_tokenizer_tmp.model", "test_tokenizer_tmp.vocab"]:
+        os.remove(file)
+
+def test_save_unsupported_pattern():
+    # A model that the file format cannot hold is an error, and nothing gets written
+    tokenizer = RegexTokenizer(pattern="\n|[^\n]+")
+    with pytest.raises(ValueError):
+        tokenizer.save("test_tokenizer_tmp")
+    assert not os.path.exists("test_tokenizer_tmp.model")
+
 if __name__ == "__main__":
     pytest.main()
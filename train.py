@@ -4,10 +4,10 @@ Train the Tokenizers on some data, just for results
 
 import os
 import time
-from minbpe import BasicTokenizer, RegerTokenizer
+from bpe import BasicTokenizer, RegexTokenizer
 
 # open some test and train a vocab of 512 tokens
-text = open("tests/taylorwisft.txt", "r", encoding="utf-8").read()
+text = open("tests/taylorswift.txt", "r", encoding="utf-8").read()
 
 # create a directory for models, so we don't pollute the current directory
 os.makedirs("models", exist_ok=True)